@@ -1,10 +1,15 @@
 import logging
 import collections
+import functools
+import itertools
 import re
+import sys
 import time
 import threading
+import types
 import traceback
 import math
+from typing import NamedTuple
 
 from django.conf import settings
 from django.db import connection
@@ -12,7 +17,7 @@ from django.core.exceptions import MiddlewareNotUsed
 
 import prometheus_client
 from prometheus_client.core import CollectorRegistry
-from prometheus_client import Counter, Gauge
+from prometheus_client import Counter, Histogram
 
 
 try:
@@ -41,7 +46,7 @@ else:
 log = logging.getLogger(__name__)
 log.addHandler(NullHandler())
 
-cfg = dict(
+cfg = types.SimpleNamespace(
     enabled=getattr(settings, "QUERY_INSPECT_ENABLED", False),
     log_stats=getattr(settings, "QUERY_INSPECT_LOG_STATS", True),
     header_stats=getattr(settings, "QUERY_INSPECT_HEADER_STATS", True),
@@ -54,42 +59,101 @@ cfg = dict(
     ),
     absolute_limit=getattr(settings, "QUERY_INSPECT_ABSOLUTE_LIMIT", None),
     sql_log_limit=getattr(settings, "QUERY_INSPECT_SQL_LOG_LIMIT", None),
+    max_queries_log=getattr(settings, "QUERY_INSPECT_MAX_QUERIES_LOG", 9000),
 )
 
+# Per-query details are only needed to log individual (duplicate or slow)
+# queries; plain stats can be computed directly from the query log.
+_need_infos = (
+    cfg.log_queries
+    or cfg.stddev_limit is not None
+    or cfg.absolute_limit is not None
+)
+# Tracebacks are only recorded if the cursor gets patched (see the bottom of
+# the module); otherwise the queries never have them.
+_collect_tb = cfg.enabled and cfg.log_tbs
+
 __all__ = ["QueryInspectMiddleware"]
 
 _local = threading.local()
 
 
+def _force_debug_cursor(db):
+    # Make Django record the queries on this connection, but only until the
+    # end of the inspected request (see process_response)
+    if not db.force_debug_cursor:
+        db.force_debug_cursor = True
+        _local.forced_dbs.append(db)
+
+
+# Frames from this module are never included in the tracebacks
+_self_file = __file__[:-1] if __file__.endswith(".pyc") else __file__
+
+_SQL_ID_RE = re.compile(r"=\s*\d+")
+_SQL_ID_SUB = _SQL_ID_RE.sub
+# Matches lists of integer ids (or placeholders), such as the ones generated
+# by prefetch_related() and __in lookups. There's no nested repetition in it,
+# so it stays linear even on very long lists.
+_IN_LIST_RE = re.compile(
+    r"\bIN\s*\(\s*(?:\d+|\?)(?:\s*,\s*(?:\d+|\?))*\s*\)", re.IGNORECASE
+)
+_IN_LIST_SUB = _IN_LIST_RE.sub
+
+
+# Only short SQL is memoized, so the cache (which lives as long as the
+# process) stays small no matter how big the queries get: at most
+# _SQL_CACHE_SIZE entries of _SQL_CACHE_MAX_LEN characters each.
+_SQL_CACHE_SIZE = 1024
+_SQL_CACHE_MAX_LEN = 1024
+
+
+def _normalize_sql_uncached(sql):
+    return _IN_LIST_SUB("IN (?)", _SQL_ID_SUB("= ?", sql))
+
+
+_normalize_sql_cached = functools.lru_cache(maxsize=_SQL_CACHE_SIZE)(
+    _normalize_sql_uncached
+)
+
+
+def _normalize_sql(sql):
+    # Long statements, such as bulk inserts, are rarely repeated verbatim,
+    # so they're normalized every time instead of filling up the cache.
+    if len(sql) > _SQL_CACHE_MAX_LEN:
+        return _normalize_sql_uncached(sql)
+    return _normalize_sql_cached(sql)
+
+
+class QueryInfo(NamedTuple):
+    sql: str
+    time: float
+    tb: list  # (filename, lineno, name) tuples, if collected
+
+
 class QueryInspectMiddleware(MiddlewareMixin):
     """A class to inspect Django SQL queries"""
 
-    class QueryInfo:
-        __slots__ = ("sql", "time", "tb", "summaries")
-
-    sql_id_pattern = re.compile(r"=\s*\d+")
+    QueryInfo = QueryInfo
+    sql_id_pattern = _SQL_ID_RE
     registry = CollectorRegistry()
 
-    sql_query_absolute_latency = Gauge(
-        name="django_sql_query_absolute_latency",
-        documentation="The latency of django SQL query in milliseconds if its"
-        " greater than the absolute limit",
-        labelnames=["file", "linenum"],
-    )
-    sql_query_stddev_latency = Gauge(
-        name="django_sql_query_stddev_latency",
-        documentation="The latency of django SQL query in milliseconds if its"
-        f" greater than than {cfg['stddev_limit']} standard deviations above "
-        "the mean query time",
-        labelnames=["file", "linenum"],
+    sql_query_latency = Histogram(
+        name="django_sql_query_latency_seconds",
+        documentation="The latency of django SQL queries in seconds that are"
+        " over the absolute limit or more than "
+        f"{cfg.stddev_limit} standard deviations above the mean query time",
+        labelnames=["limit"],
+        buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
     )
+    # There are only two limits, so this doesn't grow the number of series
+    sql_query_absolute_latency = sql_query_latency.labels(limit="absolute")
+    sql_query_stddev_latency = sql_query_latency.labels(limit="stddev")
     # sql_query_dups = Gauge(
     #     name="django_sql_query_dups",
     #     documentation="The number of django SQL query duplicates",
     #     labelnames=["file"]
     # )
-    registry.register(sql_query_absolute_latency)
-    registry.register(sql_query_stddev_latency)
+    registry.register(sql_query_latency)
     # registry.register(sql_query_dups)
 
     @classmethod
@@ -97,29 +161,40 @@ class QueryInspectMiddleware(MiddlewareMixin):
         real_exec = CursorDebugWrapper.execute
         real_exec_many = CursorDebugWrapper.executemany
 
+        roots = cfg.roots or ()
+        if isinstance(roots, str):
+            roots = roots.split(":")
+        # An empty root (e.g. from a trailing colon) would match every path
+        roots = tuple(root for root in roots if root)
+
+        # The same few files show up in every traceback
+        @functools.lru_cache(maxsize=4096)
         def should_include(path):
-            if path == __file__ or path + "c" == __file__:
-                return False
-            if not cfg["roots"]:
-                return True
-            else:
-                for root in cfg["roots"]:
-                    if path.startswith(root):
-                        return True
+            if path == _self_file:
                 return False
+            return not roots or path.startswith(roots)
 
         def tb_wrap(fn):
             def wrapper(self, *args, **kwargs):
-                if settings.DEBUG is False:
-                    self.db.force_debug_cursor = True
+                if settings.DEBUG is False and hasattr(_local, "forced_dbs"):
+                    _force_debug_cursor(self.db)
                 try:
                     return fn(self, *args, **kwargs)
                 finally:
-                    if hasattr(self.db, "queries"):
-                        tb = traceback.extract_stack()
-                        tb = [f for f in tb if should_include(f[0])]
-                        if self.db.queries:
-                            self.db.queries[-1]["tb"] = tb
+                    if hasattr(self.db, "queries_log"):
+                        # Only record where the query came from; source lines
+                        # are looked up if and when the traceback is logged
+                        tb = []
+                        f = sys._getframe(1)
+                        while f is not None:
+                            code = f.f_code
+                            path = code.co_filename
+                            if should_include(path):
+                                tb.append((path, f.f_lineno, code.co_name))
+                            f = f.f_back
+                        tb.reverse()
+                        if self.db.queries_log:
+                            self.db.queries_log[-1]["tb"] = tb
 
             return wrapper
 
@@ -132,105 +207,129 @@ class QueryInspectMiddleware(MiddlewareMixin):
 
     @classmethod
     def get_query_infos(cls, queries):
+        collect_tb = _collect_tb
         retval = []
         for q in queries:
             if q["sql"] is None:
                 continue
 
-            qi = cls.QueryInfo()
-            qi.sql = cls.sql_id_pattern.sub("= ?", q["sql"])
-            qi.time = float(q["time"])
-            qi.tb = q.get("tb")
-            qi.summaries = []  # FrameSummary objects
-            for summary in qi.tb:
-                qi.summaries.append(summary)
-            retval.append(qi)
+            retval.append(
+                cls.QueryInfo(
+                    _normalize_sql(q["sql"]),
+                    float(q["time"]),
+                    (q.get("tb") or ()) if collect_tb else (),
+                )
+            )
         return retval
 
+    @staticmethod
+    def get_query_stats(queries):
+        counts = collections.defaultdict(int)
+        sql_time = 0.0
+        for q in queries:
+            if q["sql"] is None:
+                continue
+
+            counts[_normalize_sql(q["sql"])] += 1
+            sql_time += float(q["time"])
+
+        duplicate_min = cfg.duplicate_min
+        n = sum(counts.values())
+        num_duplicates = sum(
+            num - 1 for num in counts.values() if num >= duplicate_min
+        )
+        return n, sql_time, num_duplicates
+
     @staticmethod
     def count_duplicates(infos):
-        buf = collections.defaultdict(lambda: 0)
-        for qi in infos:
-            buf[qi.sql] = buf[qi.sql] + 1
-        return sorted(buf.items(), key=lambda el: el[1], reverse=True)
+        return collections.Counter(qi.sql for qi in infos).most_common()
 
     @staticmethod
     def group_queries(infos):
-        buf = collections.defaultdict(lambda: [])
+        buf = collections.defaultdict(list)
         for qi in infos:
             buf[qi.sql].append(qi)
         return buf
 
     @classmethod
     def check_duplicates(cls, infos):
+        duplicate_min = cfg.duplicate_min
+        log_tbs = cfg.log_tbs
+
         duplicates = [
-            (qi, num)
-            for qi, num in cls.count_duplicates(infos)
-            if num >= cfg["duplicate_min"]
+            (sql, num)
+            for sql, num in cls.count_duplicates(infos)
+            if num >= duplicate_min
         ]
         duplicates.reverse()
-        n = 0
-        if len(duplicates) > 0:
-            n = sum(num for qi, num in duplicates) - len(duplicates)
-
-        dup_groups = cls.group_queries(infos)
+        n = sum(num for sql, num in duplicates) - len(duplicates)
 
-        if cfg["log_queries"]:
+        if cfg.log_queries and log.isEnabledFor(logging.WARNING):
+            # Tracebacks are only needed if they're going to be logged
+            dup_groups = cls.group_queries(infos) if log_tbs else None
             for sql, num in duplicates:
                 log.warning(
-                    "[SQL] repeated query (%dx): %s"
-                    # % (num, cls.truncate_sql(sql))
-                    % (num, sql)
+                    "[SQL] repeated query (%dx): %s",
+                    # num, cls.truncate_sql(sql),
+                    num,
+                    sql,
                 )
                 # cls.sql_query_dups.labels(file=sql).set(num)
-                if cfg["log_tbs"] and dup_groups[sql]:
+                if log_tbs and dup_groups[sql]:
                     log.warning(
-                        "Traceback:\n"
-                        + "".join(traceback.format_list(dup_groups[sql][0].tb))
+                        "Traceback:\n%s",
+                        "".join(
+                            traceback.format_list(
+                                [
+                                    traceback.FrameSummary(*frame)
+                                    for frame in dup_groups[sql][0].tb
+                                ]
+                            )
+                        ),
                     )
 
         return n
 
+    @classmethod
     def check_stddev_limit(cls, infos):
-        total = sum(qi.time for qi in infos)
+        stddev_limit = cfg.stddev_limit
         n = len(infos)
 
-        if cfg["stddev_limit"] is None or n == 0:
+        if stddev_limit is None or n == 0:
             return
 
-        mean = total / n
-        stddev_sum = sum(math.sqrt((qi.time - mean) ** 2) for qi in infos)
+        # Welford's online algorithm: mean and sample variance in one pass
+        mean = 0.0
+        m2 = 0.0
+        for i, qi in enumerate(infos, 1):
+            delta = qi.time - mean
+            mean += delta / i
+            m2 += delta * (qi.time - mean)
         if n < 2:
-            stddev = 0
+            stddev = 0.0
         else:
-            stddev = math.sqrt((1.0 / (n - 1)) * (stddev_sum / n))
+            stddev = math.sqrt(m2 / (n - 1))
 
-        query_limit = mean + (stddev * cfg["stddev_limit"])
+        query_limit = mean + (stddev * stddev_limit)
 
         for qi in infos:
             if qi.time > query_limit:
-                # Update Prometheus metrics for each file that executed a query
-                files = []
-                lines = []
-                for summary in qi.summaries:
-                    if summary is not []:
-                        f = summary.filename
-                        linenum = summary.lineno
-                        files.append(f)
-                        lines.append(linenum)
-                        cls.sql_query_stddev_latency.labels(
-                            file=f, linenum=linenum
-                        ).set(qi.time)
-                if files and lines:
+                cls.sql_query_stddev_latency.observe(qi.time)
+                f = linenum = None
+                for summary in qi.tb:
+                    if summary is not None:
+                        f, linenum = summary[0], summary[1]
+                        break
+                if f is not None:
                     log.warning(
                         "[SQL] query execution of %d ms over limit of "
                         "%d ms (%d dev above mean) in file %s, line number "
                         "%d: %s",
                         qi.time * 1000,
                         query_limit * 1000,
-                        cfg["stddev_limit"],
-                        files[0],
-                        lines[0],
+                        stddev_limit,
+                        f,
+                        linenum,
                         qi.sql,
                     )
                 else:
@@ -239,42 +338,35 @@ class QueryInspectMiddleware(MiddlewareMixin):
                         "%d ms (%d dev above mean): %s",
                         qi.time * 1000,
                         query_limit * 1000,
-                        cfg["stddev_limit"],
+                        stddev_limit,
                         qi.sql,
                     )
 
     @classmethod
     def check_absolute_limit(cls, infos):
         n = len(infos)
-        if cfg["absolute_limit"] is None or n == 0:
+        if cfg.absolute_limit is None or n == 0:
             return
 
-        query_limit = cfg["absolute_limit"] / 1000.0
+        query_limit = cfg.absolute_limit / 1000.0
 
         for qi in infos:
             if qi.time > query_limit:
-                files = []
-                lines = []
-                for summary in qi.summaries:
-                    if summary is not []:
-                        f = summary.filename
-                        linenum = summary.lineno
-                        files.append(f)
-                        lines.append(linenum)
-                        # Update Prometheus metrics for each file that executed
-                        # a query
-                        cls.sql_query_absolute_latency.labels(
-                            file=f, linenum=linenum
-                        ).set(qi.time)
-                if files and lines:
+                cls.sql_query_absolute_latency.observe(qi.time)
+                f = linenum = None
+                for summary in qi.tb:
+                    if summary is not None:
+                        f, linenum = summary[0], summary[1]
+                        break
+                if f is not None:
                     log.warning(
                         "[SQL] query execution of %d ms over absolute "
                         "limit of %d ms  in file %s, line number "
                         "%d: %s",
                         qi.time * 1000,
                         query_limit * 1000,
-                        files[0],
-                        lines[0],
+                        f,
+                        linenum,
                         qi.sql,
                     )
                 else:
@@ -289,44 +381,55 @@ class QueryInspectMiddleware(MiddlewareMixin):
 
     @staticmethod
     def truncate_sql(sql):
-        limit = cfg["sql_log_limit"]
+        limit = cfg.sql_log_limit
         if limit and len(sql) > limit:
             n = (limit - 5) // 2
             sql = sql[:n] + " ... " + sql[-n:]
         return sql
 
     @classmethod
-    def output_stats(self, infos, num_duplicates, request_time, response):
-        sql_time = sum(qi.time for qi in infos)
-        n = len(infos)
-
-        if cfg["log_stats"]:
+    def output_stats(
+        self, n, sql_time, num_duplicates, request_time, response
+    ):
+        if cfg.log_stats:
             log.info(
                 "[SQL] %d queries (%d duplicates), %d ms SQL time, "
-                "%d ms total request time"
-                % (n, num_duplicates, sql_time * 1000, request_time * 1000)
+                "%d ms total request time",
+                n,
+                num_duplicates,
+                sql_time * 1000,
+                request_time * 1000,
             )
 
-        if cfg["header_stats"]:
+        if cfg.header_stats:
+            sql_ms = int(sql_time * 1000)
+            request_ms = int(request_time * 1000)
+            # Set one by one, HttpResponse.headers is new in Django 3.2
             response["X-QueryInspect-Num-SQL-Queries"] = str(n)
-            response["X-QueryInspect-Total-SQL-Time"] = "%d ms" % (
-                sql_time * 1000
-            )
-            response["X-QueryInspect-Total-Request-Time"] = "%d ms" % (
-                request_time * 1000
-            )
+            response["X-QueryInspect-Total-SQL-Time"] = f"{sql_ms} ms"
+            response["X-QueryInspect-Total-Request-Time"] = f"{request_ms} ms"
             response["X-QueryInspect-Duplicate-SQL-Queries"] = str(
                 num_duplicates
             )
 
     def __init__(self, get_response=None):
-        if not cfg["enabled"]:
+        if not cfg.enabled:
             raise MiddlewareNotUsed()
         super().__init__(get_response)
 
     def process_request(self, request):
         _local.request_start = time.time()
-        _local.conn_queries_len = len(connection.queries)
+        _local.forced_dbs = []
+        if _collect_tb and settings.DEBUG is False:
+            _force_debug_cursor(connection)
+
+        # Read the query log directly: connection.queries copies all of it
+        queries_log = connection.queries_log
+        if queries_log.maxlen != cfg.max_queries_log:
+            queries_log = connection.queries_log = collections.deque(
+                queries_log, maxlen=cfg.max_queries_log
+            )
+        _local.conn_queries_len = len(queries_log)
 
     def process_response(self, request, response):
         if not hasattr(_local, "request_start"):
@@ -334,19 +437,36 @@ class QueryInspectMiddleware(MiddlewareMixin):
 
         request_time = time.time() - _local.request_start
 
-        infos = self.get_query_infos(
-            connection.queries[_local.conn_queries_len :]
-        )
+        queries_log = connection.queries_log
+        start = _local.conn_queries_len
+
+        if len(queries_log) == start:
+            # No queries were made, so there's nothing to inspect
+            n, sql_time, num_duplicates = 0, 0.0, 0
+        elif _need_infos:
+            infos = self.get_query_infos(
+                itertools.islice(queries_log, start, None)
+            )
+            num_duplicates = self.check_duplicates(infos)
+            self.check_stddev_limit(infos)
+            self.check_absolute_limit(infos)
+            n = len(infos)
+            sql_time = sum(qi.time for qi in infos)
+        else:
+            n, sql_time, num_duplicates = self.get_query_stats(
+                itertools.islice(queries_log, start, None)
+            )
+
+        self.output_stats(n, sql_time, num_duplicates, request_time, response)
 
-        num_duplicates = self.check_duplicates(infos)
-        self.check_stddev_limit(infos)
-        self.check_absolute_limit(infos)
-        self.output_stats(infos, num_duplicates, request_time, response)
+        for db in _local.forced_dbs:
+            db.force_debug_cursor = False
 
         del _local.request_start
+        del _local.forced_dbs
         del _local.conn_queries_len
         return response
 
 
-if cfg["enabled"] and cfg["log_tbs"]:
+if _collect_tb:
     QueryInspectMiddleware.patch_cursor()
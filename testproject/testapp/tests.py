@@ -1,6 +1,12 @@
+import collections
+from unittest import mock
+
 from django.test import TestCase
 
 from django.conf import settings
+from django.db import connection
+from qinspect import middleware
+from qinspect.middleware import QueryInspectMiddleware
 from .models import Author, Book, Publisher
 from .memorylog import MemoryHandler
 
@@ -104,6 +110,99 @@ class TestQueryInspect(TestCase):
         self.assertTrue('X-QueryInspect-Total-Request-Time' in response)
         self.assertEqual(response['X-QueryInspect-Duplicate-SQL-Queries'], '9')
 
+    def test_no_queries_view(self):
+        with self.settings(DEBUG=True):
+            response = self.client.get('/empty/')
+
+        log = MemoryHandler.get_log()
+
+        self.assertIn('[SQL] 0 queries (0 duplicates), 0 ms SQL time', log)
+        self.assertEqual(response['X-QueryInspect-Num-SQL-Queries'], '0')
+        self.assertEqual(response['X-QueryInspect-Total-SQL-Time'], '0 ms')
+        self.assertEqual(response['X-QueryInspect-Duplicate-SQL-Queries'], '0')
+
+    def test_in_list_normalization(self):
+        queries = [
+            {'sql': 'SELECT * FROM "book" WHERE "book"."id" IN (1, 2, 3)',
+                'time': '0.001', 'tb': []},
+            {'sql': 'SELECT * FROM "book" WHERE "book"."id" IN (4,5)',
+                'time': '0.001', 'tb': []},
+            {'sql': 'SELECT COALESCE(MIN(5), 0) FROM "book"',
+                'time': '0.001', 'tb': []},
+        ]
+        infos = QueryInspectMiddleware.get_query_infos(queries)
+
+        self.assertEqual(infos[0].sql,
+            'SELECT * FROM "book" WHERE "book"."id" IN (?)')
+        self.assertEqual(infos[0].sql, infos[1].sql)
+        self.assertEqual(infos[2].sql,
+            'SELECT COALESCE(MIN(5), 0) FROM "book"')
+
+    def test_stddev_limit(self):
+        times = ['0.001'] * 9 + ['0.100']
+        queries = [
+            {'sql': 'SELECT %d' % i, 'time': t, 'tb': []}
+            for i, t in enumerate(times)]
+        infos = QueryInspectMiddleware.get_query_infos(queries)
+
+        MemoryHandler.get_log()
+        QueryInspectMiddleware.check_stddev_limit(infos)
+        log = MemoryHandler.get_log()
+
+        # mean is 10.9 ms and sample standard deviation is 31.3 ms
+        self.assertIn('query execution of 100 ms over limit of 42 ms', log)
+        self.assertEqual(log.count('over limit of'), 1)
+
+    def test_query_stats(self):
+        queries = [
+            {'sql': 'SELECT * FROM "book" WHERE "book"."id" = %d' % i,
+                'time': '0.002'}
+            for i in range(3)]
+        queries.append({'sql': 'SELECT * FROM "author"', 'time': '0.004'})
+        queries.append({'sql': None, 'time': '0.000'})
+
+        n, sql_time, num_duplicates = \
+            QueryInspectMiddleware.get_query_stats(queries)
+
+        self.assertEqual(n, 4)
+        self.assertAlmostEqual(sql_time, 0.010)
+        self.assertEqual(num_duplicates, 2)
+
+    def test_non_debug_cursor(self):
+        self.author = Author.objects.create(name='Author')
+        self.publisher = Publisher.objects.create(name='Publisher')
+        Book.objects.create(
+            title='Book', author=self.author, publisher=self.publisher)
+
+        with self.settings(DEBUG=False):
+            response = self.client.get('/book/')
+
+            self.assertEqual(response['X-QueryInspect-Num-SQL-Queries'], '1')
+            self.assertFalse(connection.force_debug_cursor)
+
+            num_logged = len(connection.queries_log)
+            Book.objects.count()
+            self.assertEqual(len(connection.queries_log), num_logged)
+
+    def test_max_queries_log(self):
+        self.author = Author.objects.create(name='Author')
+        self.publisher = Publisher.objects.create(name='Publisher')
+        for i in range(10):
+            Book.objects.create(
+                title='Book %d' % i,
+                author=self.author,
+                publisher=self.publisher)
+        self.addCleanup(setattr, connection, 'queries_log',
+            collections.deque(maxlen=connection.queries_limit))
+
+        with mock.patch.object(middleware.cfg, 'max_queries_log', 5):
+            with self.settings(DEBUG=True):
+                response = self.client.get('/authors/')
+
+        # Only the last 5 of the 12 queries are kept and inspected
+        self.assertEqual(connection.queries_log.maxlen, 5)
+        self.assertEqual(response['X-QueryInspect-Num-SQL-Queries'], '5')
+
     def test_non_debug_mode(self):
         settings.DEBUG = False
         self.test_single_query_view()
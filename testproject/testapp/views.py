@@ -26,3 +26,7 @@ def get_authors_with_books(request):
 def book(request):
     book = Book.objects.all()[0]
     return JsonResponse({'title': book.title})
+
+
+def no_queries(request):
+    return JsonResponse({})
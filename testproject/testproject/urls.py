@@ -1,7 +1,7 @@
 from django.conf.urls import url, include
 from django import VERSION
 
-from testapp.views import get_authors_with_books, book
+from testapp.views import get_authors_with_books, book, no_queries
 
 if VERSION >= (1, 9):
     def patterns(prefix, *args):
@@ -12,4 +12,5 @@ else:
 urlpatterns = patterns('testapp.views',
     url(r'^authors/$', get_authors_with_books, name='authors'),
     url(r'^book/$', book, name='book'),
+    url(r'^empty/$', no_queries, name='empty'),
 )